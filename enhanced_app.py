@@ -1,15 +1,20 @@
 import streamlit as st
 import pandas as pd
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, Json, execute_values
+import select
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
-import plotly.express as px
+from functools import lru_cache
 import io
-import base64
+import itertools
+import time
 import uuid
 import json
 import hashlib
+import hmac
 import os
 from urllib.parse import urlparse
 
@@ -23,10 +28,56 @@ st.set_page_config(
     initial_sidebar_state="expanded"
 )
 
+# Widget option lists, built once — identity-stable objects also let
+# Streamlit's widget diffing skip re-render work
+EXPENSE_CATEGORIES = (
+    "Stationery", "Food", "Fuel", "Maintenance",
+    "Salaries", "Utilities", "Transport", "Events", "Mechanic", "Other"
+)
+UNIFORM_ITEMS = (
+    "Sweater", "Tracksuit", "Dress", "T-shirt",
+    "Trousers", "Shirt", "Tie", "Socks", "Blazer", "PE Kit"
+)
+PAYMENT_MODES = ("Cash", "M-Pesa", "Bank Transfer", "Cheque", "Other")
+
 # ======================
 # DATABASE FUNCTIONS
 # ======================
 
+def hash_password(password, salt):
+    """SHA-256 digest of a password, as stored in users.pwhash.
+
+    salt is per-user random bytes stored next to the digest, so accounts
+    with the same password never share a digest."""
+    return hashlib.sha256(salt + password.encode()).digest()
+
+def check_login(conn, username, password):
+    """Validate credentials against the users table.
+
+    The primary-key lookup is O(log N) and the digest comparison is
+    constant-time, so login cost stays flat as accounts are added."""
+    result = execute_query(conn, "SELECT pwhash, salt FROM users WHERE username = %s",
+                           (username,), fetch=True)
+    if not result or result[0]['salt'] is None:
+        return False
+    stored = bytes(result[0]['pwhash'])
+    salt = bytes(result[0]['salt'])
+    return hmac.compare_digest(stored, hash_password(password, salt))
+
+def get_initial_admin_password():
+    """Initial admin credential from the environment or Streamlit secrets.
+
+    Never a literal in source: when nothing is configured no account is
+    seeded, so a fresh deployment can't ship a well-known login."""
+    if "ADMIN_PASSWORD" in os.environ:
+        return os.environ["ADMIN_PASSWORD"]
+    try:
+        if hasattr(st, 'secrets') and 'admin' in st.secrets and 'password' in st.secrets.admin:
+            return st.secrets.admin.password
+    except Exception:
+        pass
+    return None
+
 def get_database_url():
     """Get database URL from environment variables or Streamlit secrets"""
     # Try Railway environment variable first
@@ -71,28 +122,33 @@ def is_connection_active(conn):
     except Exception:
         return False
 
-def execute_query(conn, query, params=None, fetch=False, retry_count=0):
-    """Execute database query with better error handling and retry mechanism."""
+def execute_query(conn, query, params=None, fetch=False, commit=None, retry_count=0):
+    """Execute database query with better error handling and retry mechanism.
+
+    commit defaults to True for plain writes and False for fetches; pass
+    commit=True explicitly for writes that also fetch (e.g. RETURNING)."""
     max_retries = 1 # Allow one retry if connection fails
-    
+
+    if commit is None:
+        commit = not fetch
+
     try:
         if not is_connection_active(conn):
             st.warning("Database connection is not active. Attempting to re-establish...")
             # Re-establish connection through the cached function
-            conn = get_db_connection(force_reconnect=True) 
+            conn = get_db_connection(force_reconnect=True)
             if not conn:
                 st.error("Failed to re-establish database connection.")
                 return False if not fetch else None
 
         with conn.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute(query, params)
-            
-            if fetch:
-                return cursor.fetchall()
-            else:
-                conn.commit()
-                return True
-                
+            rows = cursor.fetchall() if fetch else None
+
+        if commit:
+            conn.commit()
+        return rows if fetch else True
+
     except psycopg2.Error as e:
         # Check if the error is due to a closed connection and retry
         if "connection already closed" in str(e).lower() and retry_count < max_retries:
@@ -100,7 +156,7 @@ def execute_query(conn, query, params=None, fetch=False, retry_count=0):
             # Force re-initialization of the connection
             conn = get_db_connection(force_reconnect=True)
             if conn:
-                return execute_query(conn, query, params, fetch, retry_count + 1)
+                return execute_query(conn, query, params, fetch, commit, retry_count + 1)
             else:
                 st.error("Failed to re-establish connection after retry.")
                 return False if not fetch else None
@@ -118,6 +174,34 @@ def execute_query(conn, query, params=None, fetch=False, retry_count=0):
         st.code(traceback.format_exc())
         return False if not fetch else None
 
+def execute_values_query(conn, query, rows):
+    """Run a multi-row INSERT ... VALUES %s as one statement.
+
+    execute_values collapses N row inserts into a single round-trip instead
+    of N sequential statements."""
+    if not rows:
+        return True
+
+    try:
+        if not is_connection_active(conn):
+            st.warning("Database connection is not active. Attempting to re-establish...")
+            conn = get_db_connection(force_reconnect=True)
+            if not conn:
+                st.error("Failed to re-establish database connection.")
+                return False
+
+        with conn.cursor() as cursor:
+            execute_values(cursor, query, rows, page_size=500)
+        conn.commit()
+        return True
+
+    except psycopg2.Error as e:
+        if is_connection_active(conn):
+            conn.rollback()
+        st.error(f"Database error: {e}")
+        st.code(traceback.format_exc())
+        return False
+
 def init_database():
     """Initialize database with required tables"""
     try:
@@ -157,7 +241,9 @@ def init_database():
             st.success(f"✅ Connected successfully!")
             
         # Create tables
+        tune_session(conn)
         create_tables(conn)
+        prepare_statements(conn)
         return conn
         
     except psycopg2.OperationalError as e:
@@ -231,13 +317,20 @@ def create_tables(conn):
             receipt_id VARCHAR(255) UNIQUE NOT NULL,
             date DATE NOT NULL,
             customer_name VARCHAR(255),
-            items_json TEXT NOT NULL,
+            items_json JSONB NOT NULL,
             total_amount NUMERIC(10, 2) NOT NULL,
             payment_mode VARCHAR(100) NOT NULL,
             reference VARCHAR(255),
             issued_by VARCHAR(255) NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            username VARCHAR(100) PRIMARY KEY,
+            pwhash BYTEA NOT NULL,
+            salt BYTEA NOT NULL
+        )
         '''
     ]
     
@@ -245,18 +338,159 @@ def create_tables(conn):
         with conn.cursor() as cursor:
             for table_sql in tables:
                 cursor.execute(table_sql)
-            
+
+            # Migrate 'items_json' from TEXT to JSONB on older deployments so
+            # receipt-item lookups can run server-side against the GIN index
+            cursor.execute("""
+                DO $$
+                BEGIN
+                    IF EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='receipts' AND column_name='items_json' AND data_type='text') THEN
+                        ALTER TABLE receipts ALTER COLUMN items_json TYPE JSONB USING items_json::jsonb;
+                    END IF;
+                END
+                $$;
+            """)
+
             # Add indexes for better performance
             indexes = [
                 "CREATE INDEX IF NOT EXISTS idx_expenses_date ON expenses(date)",
                 "CREATE INDEX IF NOT EXISTS idx_sales_date ON uniform_sales(date)",
-                "CREATE INDEX IF NOT EXISTS idx_stock_item_size ON uniform_stock(item, size)",
-                "CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts(date)"
+                # Unique index backs the ON CONFLICT upsert in the stock
+                # form and supersedes the old non-unique (item, size) index
+                "DROP INDEX IF EXISTS idx_stock_item_size",
+                "CREATE UNIQUE INDEX IF NOT EXISTS uq_stock_item_size ON uniform_stock(item, size)",
+                "CREATE INDEX IF NOT EXISTS idx_receipts_date ON receipts(date)",
+                # Recent-activity and receipt history order by created_at
+                "CREATE INDEX IF NOT EXISTS idx_sales_created_at ON uniform_sales(created_at)",
+                "CREATE INDEX IF NOT EXISTS idx_receipts_created_at ON receipts(created_at)",
+                # Covering composite indexes: INCLUDE carries the summed
+                # columns so range aggregates run as index-only scans
+                "DROP INDEX IF EXISTS idx_expenses_date_cat",
+                "DROP INDEX IF EXISTS idx_sales_date_item",
+                "DROP INDEX IF EXISTS idx_stock_quantity",
+                "CREATE INDEX IF NOT EXISTS idx_expenses_date_cat_inc ON expenses(date, category) INCLUDE (amount)",
+                "CREATE INDEX IF NOT EXISTS idx_sales_date_item_inc ON uniform_sales(date, item) INCLUDE (quantity, selling_price)",
+                "CREATE INDEX IF NOT EXISTS idx_receipts_items_gin ON receipts USING GIN (items_json)",
+                # Partial index: only low rows qualify, so it stays tiny
+                "CREATE INDEX IF NOT EXISTS idx_stock_low ON uniform_stock(quantity) WHERE quantity <= 5",
+                "CREATE INDEX IF NOT EXISTS idx_expenses_month ON expenses (DATE_TRUNC('month', date))",
+                "CREATE INDEX IF NOT EXISTS idx_sales_month ON uniform_sales (DATE_TRUNC('month', date))"
             ]
             
             for index_sql in indexes:
                 cursor.execute(index_sql)
 
+            # Per-user salts replaced the old static application salt; add
+            # the column on databases created before it existed
+            cursor.execute("""
+                DO $$
+                BEGIN
+                    IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='users' AND column_name='salt') THEN
+                        ALTER TABLE users ADD COLUMN salt BYTEA;
+                    END IF;
+                END
+                $$;
+            """)
+
+            # Retire the old well-known admin/admin123 seed: only the row
+            # still holding exactly that legacy digest is removed
+            legacy_digest = hashlib.sha256(b"school-expense-tracker" + b"admin123").digest()
+            cursor.execute("DELETE FROM users WHERE username = 'admin' AND pwhash = %s",
+                           (legacy_digest,))
+
+            # Seed the initial account only when a credential is configured
+            # via the environment or secrets — never from a source literal
+            initial_password = get_initial_admin_password()
+            if initial_password:
+                salt = os.urandom(16)
+                cursor.execute(
+                    "INSERT INTO users (username, pwhash, salt) VALUES (%s, %s, %s) ON CONFLICT DO NOTHING",
+                    ("admin", hash_password(initial_password, salt), salt)
+                )
+
+            # Broadcast writes so other sessions can drop their caches
+            # instead of polling (see get_change_listener)
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION notify_data_changed() RETURNS trigger AS $$
+                BEGIN
+                    PERFORM pg_notify('data_changed', TG_TABLE_NAME);
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            for table in ("expenses", "uniform_sales", "uniform_stock", "receipts"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_notify ON {table}")
+                cursor.execute(f'''
+                    CREATE TRIGGER trg_{table}_notify
+                    AFTER INSERT OR UPDATE OR DELETE ON {table}
+                    FOR EACH STATEMENT EXECUTE PROCEDURE notify_data_changed()
+                ''')
+
+            # Derived quick-stats row, recomputed by trigger on every write to
+            # sales or stock. UNLOGGED: no WAL cost, safe because it's derived
+            cursor.execute('''
+                CREATE UNLOGGED TABLE IF NOT EXISTS dashboard_summary (
+                    month DATE PRIMARY KEY,
+                    total_transactions INTEGER NOT NULL,
+                    avg_sale_value NUMERIC(10, 2) NOT NULL,
+                    unique_customers INTEGER NOT NULL,
+                    total_stock_items INTEGER NOT NULL,
+                    refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('''
+                CREATE OR REPLACE FUNCTION bump_dashboard_summary() RETURNS trigger AS $$
+                BEGIN
+                    INSERT INTO dashboard_summary (
+                        month, total_transactions, avg_sale_value,
+                        unique_customers, total_stock_items, refreshed_at
+                    )
+                    SELECT date_trunc('month', CURRENT_DATE),
+                           COUNT(*),
+                           COALESCE(AVG(quantity * selling_price), 0),
+                           COUNT(DISTINCT student_name),
+                           (SELECT COALESCE(SUM(quantity), 0) FROM uniform_stock),
+                           CURRENT_TIMESTAMP
+                    FROM uniform_sales
+                    WHERE date >= date_trunc('month', CURRENT_DATE)
+                    ON CONFLICT (month) DO UPDATE SET
+                        total_transactions = EXCLUDED.total_transactions,
+                        avg_sale_value = EXCLUDED.avg_sale_value,
+                        unique_customers = EXCLUDED.unique_customers,
+                        total_stock_items = EXCLUDED.total_stock_items,
+                        refreshed_at = EXCLUDED.refreshed_at;
+                    RETURN NULL;
+                END;
+                $$ LANGUAGE plpgsql
+            ''')
+            for table in ("uniform_sales", "uniform_stock"):
+                cursor.execute(f"DROP TRIGGER IF EXISTS trg_{table}_summary ON {table}")
+                cursor.execute(f'''
+                    CREATE TRIGGER trg_{table}_summary
+                    AFTER INSERT OR UPDATE OR DELETE ON {table}
+                    FOR EACH STATEMENT EXECUTE PROCEDURE bump_dashboard_summary()
+                ''')
+
+            # Pre-aggregated monthly totals for the trends report: queries
+            # against it are O(months), not O(rows). Refreshed after writes
+            # via refresh_monthly_financials
+            cursor.execute('''
+                CREATE MATERIALIZED VIEW IF NOT EXISTS mv_monthly_financials AS
+                SELECT COALESCE(e.month, s.month) as month,
+                       COALESCE(e.expenses, 0) as expenses,
+                       COALESCE(s.sales, 0) as sales
+                FROM (
+                    SELECT DATE_TRUNC('month', date) as month, SUM(amount) as expenses
+                    FROM expenses GROUP BY 1
+                ) e
+                FULL OUTER JOIN (
+                    SELECT DATE_TRUNC('month', date) as month, SUM(quantity * selling_price) as sales
+                    FROM uniform_sales GROUP BY 1
+                ) s USING (month)
+            ''')
+            cursor.execute(
+                "CREATE UNIQUE INDEX IF NOT EXISTS uq_mv_monthly_month ON mv_monthly_financials(month)")
+
             # Ensure 'created_at' column exists in 'expenses' table for older deployments
             # This is a safe way to add the column if it's missing without dropping the table
             cursor.execute("""
@@ -275,6 +509,156 @@ def create_tables(conn):
     except Exception as e:
         st.error(f"Failed to create tables: {e}")
         conn.rollback()
+        return
+
+    # Trigram index lets the ILIKE '%term%' description search use an index.
+    # Kept separate: pg_trgm needs the extension, which some managed hosts
+    # don't allow — the app works fine without it
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_expenses_desc_trgm
+                ON expenses USING GIN (description gin_trgm_ops)
+            """)
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_sales_search_trgm
+                ON uniform_sales USING GIN (student_name gin_trgm_ops, reference gin_trgm_ops)
+            """)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+
+def tune_session(conn):
+    """Tune per-session Postgres settings for this app's workload.
+
+    The app is read-heavy with occasional single-row writes, so we trade a
+    tiny durability window (synchronous_commit=off: a crash can lose the
+    last few commits, never corrupt data) for fsync-free INSERT latency,
+    and give the report aggregates a larger sort/hash budget."""
+    # No idle_in_transaction_session_timeout here: read paths leave the
+    # shared connection idle in transaction between reruns, so that GUC
+    # would kill it after any pause and force a reconnect + re-PREPARE.
+    settings = [
+        "SET synchronous_commit = off",
+        "SET work_mem = '32MB'",
+        "SET statement_timeout = '30s'",
+    ]
+    try:
+        with conn.cursor() as cursor:
+            for setting_sql in settings:
+                cursor.execute(setting_sql)
+        conn.commit()
+    except Exception as e:
+        # Session tuning is an optimization; managed hosts may restrict GUCs
+        conn.rollback()
+        st.warning(f"Could not apply session settings: {e}")
+
+# Hot dashboard queries, written once with pyformat placeholders. Each runs
+# as a server-side prepared statement when PREPARE succeeded for this
+# session, and falls back to the identical inline SQL when it didn't —
+# PREPARE is best-effort on managed hosts, and the dashboard must still
+# render real numbers without it.
+_DASHBOARD_SQL = {
+    'dashboard_categories': '''
+        SELECT category, COALESCE(SUM(amount), 0) as total
+        FROM expenses
+        WHERE date >= %(month_start)s
+        GROUP BY category
+        ORDER BY total DESC
+    ''',
+    'dashboard_top_items': '''
+        SELECT item, SUM(quantity) as total_qty,
+               SUM(quantity * selling_price) as total_revenue
+        FROM uniform_sales
+        WHERE date >= %(month_start)s
+        GROUP BY item
+        ORDER BY total_revenue DESC
+        LIMIT 5
+    ''',
+    'dashboard_low_stock': '''
+        SELECT item, size, quantity, unit_cost, COUNT(*) OVER () as total_low
+        FROM uniform_stock
+        WHERE quantity <= 5 AND quantity > 0
+        ORDER BY quantity ASC
+        LIMIT 4
+    ''',
+    'dashboard_headline': '''
+        SELECT e.total_expenses, e.ytd_expenses, s.total_sales, s.ytd_sales, i.stock_value
+        FROM (
+            SELECT COALESCE(SUM(CASE WHEN date >= %(month_start)s THEN amount END), 0) as total_expenses,
+                   COALESCE(SUM(amount), 0) as ytd_expenses
+            FROM expenses
+            WHERE date >= %(year_start)s
+        ) e
+        CROSS JOIN (
+            SELECT COALESCE(SUM(CASE WHEN date >= %(month_start)s THEN quantity * selling_price END), 0) as total_sales,
+                   COALESCE(SUM(quantity * selling_price), 0) as ytd_sales
+            FROM uniform_sales
+            WHERE date >= %(year_start)s
+        ) s
+        CROSS JOIN (
+            SELECT COALESCE(SUM(quantity * unit_cost), 0) as stock_value
+            FROM uniform_stock
+        ) i
+    ''',
+    'stock_totals': '''
+        SELECT COALESCE(SUM(quantity), 0) as total_items,
+               COALESCE(SUM(quantity * unit_cost), 0) as total_value
+        FROM uniform_stock
+    ''',
+}
+
+# PREPARE signature and placeholder-to-$n mapping for each query above
+_PREPARE_SPECS = {
+    'dashboard_categories': ('(date)', {'month_start': '$1'}),
+    'dashboard_top_items': ('(date)', {'month_start': '$1'}),
+    'dashboard_low_stock': ('', {}),
+    'dashboard_headline': ('(date, date)', {'month_start': '$1', 'year_start': '$2'}),
+    'stock_totals': ('', {}),
+}
+
+# EXECUTE form of each query, taking the same pyformat parameters
+_EXECUTE_SQL = {
+    'dashboard_categories': "EXECUTE dashboard_categories(%(month_start)s)",
+    'dashboard_top_items': "EXECUTE dashboard_top_items(%(month_start)s)",
+    'dashboard_low_stock': "EXECUTE dashboard_low_stock",
+    'dashboard_headline': "EXECUTE dashboard_headline(%(month_start)s, %(year_start)s)",
+    'stock_totals': "EXECUTE stock_totals",
+}
+
+# Whether prepare_statements succeeded for the current session connection
+_prepared_ready = False
+
+def prepare_statements(conn):
+    """Prepare the hot dashboard queries server-side for this session.
+
+    Postgres then skips parse+plan on every dashboard render; the dashboard
+    runs them via EXECUTE <name>(...). When PREPARE fails the fetchers fall
+    back to the inline SQL instead (see run_dashboard_query)."""
+    global _prepared_ready
+    _prepared_ready = False
+    try:
+        with conn.cursor() as cursor:
+            # Statement names are session-scoped; clear any from a prior init
+            cursor.execute("DEALLOCATE ALL")
+            for name, (arg_types, arg_map) in _PREPARE_SPECS.items():
+                body = _DASHBOARD_SQL[name] % arg_map if arg_map else _DASHBOARD_SQL[name]
+                cursor.execute(f"PREPARE {name}{arg_types} AS {body}")
+        conn.commit()
+        _prepared_ready = True
+    except Exception as e:
+        # Prepared statements are an optimization, not a requirement
+        conn.rollback()
+        st.warning(f"Could not prepare statements: {e}")
+
+def run_dashboard_query(conn, name, params=None):
+    """Run one dashboard query, preferring its prepared statement.
+
+    Uses the inline SQL when this session's PREPARE failed, so the
+    dashboard degrades to parse-per-query instead of erroring out."""
+    sql = _EXECUTE_SQL[name] if _prepared_ready else _DASHBOARD_SQL[name]
+    return execute_query(conn, sql, params, fetch=True)
 
 @st.cache_resource
 def get_db_connection(force_reconnect=False):
@@ -284,40 +668,174 @@ def get_db_connection(force_reconnect=False):
         st.cache_resource.clear() # Clear the cache to force a new connection
     return init_database()
 
+@st.cache_resource
+def get_change_listener():
+    """Background LISTEN connection that drops caches when any session writes.
+
+    Writes in this session already clear the data cache directly; the
+    listener covers writes made by *other* users, so cached aggregates stay
+    valid while idle instead of being re-fetched on a timer."""
+    def _listen():
+        try:
+            database_url = get_database_url()
+            if not database_url:
+                return
+            listen_conn = psycopg2.connect(database_url, sslmode='require',
+                                           application_name='school_expense_tracker_listener')
+            listen_conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            with listen_conn.cursor() as cursor:
+                cursor.execute("LISTEN data_changed")
+            while True:
+                if select.select([listen_conn], [], [], 10) == ([], [], []):
+                    continue
+                listen_conn.poll()
+                if listen_conn.notifies:
+                    del listen_conn.notifies[:]
+                    st.cache_data.clear()
+        except Exception:
+            # Invalidation falls back to the cache TTLs if listening fails
+            pass
+
+    thread = threading.Thread(target=_listen, daemon=True)
+    thread.start()
+    return thread
+
+# ======================
+# BACKGROUND WRITES
+# ======================
+_write_conn = None
+
+@st.cache_resource
+def get_write_executor():
+    """Single background worker so DB commits can overlap with rendering.
+
+    One worker on one dedicated connection keeps background commits
+    serialized among themselves and, crucially, off the UI session's
+    connection — psycopg2 commit()/rollback() are connection-wide, so a
+    background failure on a shared connection could roll back an in-flight
+    UI transaction."""
+    return ThreadPoolExecutor(max_workers=1)
+
+def _get_write_connection():
+    """Dedicated connection for the write executor, created lazily on the
+    worker thread (mirrors the listener's own connection).
+
+    Autocommit: every background job is a single statement, and
+    REFRESH MATERIALIZED VIEW CONCURRENTLY refuses to run inside a
+    transaction block."""
+    global _write_conn
+    if _write_conn is None or _write_conn.closed:
+        _write_conn = psycopg2.connect(get_database_url(), sslmode='require',
+                                       application_name='school_expense_tracker_writer')
+        _write_conn.autocommit = True
+    return _write_conn
+
+def _background_execute(query, params=None):
+    """Run one write on the dedicated connection.
+
+    Executes on the worker thread, so no st.* calls here (they're no-ops
+    without a ScriptRunContext) — failures are raised and surfaced by
+    reap_pending_writes on a later rerun."""
+    conn = _get_write_connection()
+    with conn.cursor() as cursor:
+        cursor.execute(query, params or ())
+    return True
+
+def submit_background_write(query, params=None, toast=True):
+    """Queue a non-critical write on the executor instead of blocking the UI.
+
+    toast=False for maintenance jobs (e.g. view refreshes) that shouldn't
+    report a save the user never made."""
+    future = get_write_executor().submit(_background_execute, query, params)
+    st.session_state.setdefault("pending_writes", []).append((future, toast))
+    return future
+
+def refresh_monthly_financials():
+    """Queue a refresh of the monthly totals view after a write.
+
+    Runs on the write executor so the form submit doesn't wait for the
+    re-aggregation. CONCURRENTLY (backed by uq_mv_monthly_month) so the
+    refresh never takes ACCESS EXCLUSIVE: UI connections routinely sit
+    idle in transaction holding ACCESS SHARE on the view after a read,
+    and a plain REFRESH queued behind that would block the single-worker
+    executor — and every reader after it — indefinitely."""
+    submit_background_write("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_monthly_financials",
+                            toast=False)
+
+def reap_pending_writes():
+    """Collect finished background writes and surface any failures"""
+    pending = st.session_state.get("pending_writes", [])
+    still_pending = []
+    for future, toast in pending:
+        if future.done():
+            if future.exception() is not None:
+                st.error("A background save failed. Please check your recent entries.")
+            elif toast:
+                st.toast("Saved ✅")
+        else:
+            still_pending.append((future, toast))
+    st.session_state.pending_writes = still_pending
+
 # ======================
 # UTILITY FUNCTIONS
 # ======================
+# Monotonic suffix makes IDs collision-free by construction, where the old
+# 8-hex uuid4 slice only had 32 bits of collision space
+_id_counter = itertools.count()
+
 def generate_unique_id(prefix=""):
     """Generate a unique ID with optional prefix"""
-    return f"{prefix}{uuid.uuid4().hex[:8].upper()}"
+    n = (int(time.time() * 1000) << 16) | (next(_id_counter) & 0xFFFF)
+    return f"{prefix}{n:X}"
+
+@lru_cache(maxsize=1024)
+def _format_cents(cents):
+    return f"KES {cents / 100:,.2f}"
 
 def format_currency(amount):
-    """Format amount as currency"""
+    """Format amount as currency.
+
+    Keyed on whole cents so repeated prices across receipt rows and
+    metrics reuse one formatted string instead of re-running the
+    format machinery."""
     if amount is None:
         return "KES 0.00"
-    return f"KES {float(amount):,.2f}"
+    return _format_cents(round(float(amount) * 100))
+
+@st.cache_data(show_spinner=False)
+def to_csv_bytes(df):
+    """Serialize a DataFrame to CSV bytes, cached on the frame's content.
+
+    pyarrow (already shipped with Streamlit) writes CSV in vectorized C++
+    straight to a buffer, skipping pandas' Python str build + encode."""
+    import pyarrow as pa
+    import pyarrow.csv
 
-def get_download_link(df, filename, text):
-    """Generate a CSV download link"""
-    csv = df.to_csv(index=False)
-    b64 = base64.b64encode(csv.encode()).decode()
-    return f'<a href="data:file/csv;base64,{b64}" download="{filename}.csv">{text}</a>'
+    buffer = pa.BufferOutputStream()
+    pa.csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), buffer)
+    return buffer.getvalue().to_pybytes()
 
-def get_excel_link(df, filename, text):
-    """Generate an Excel download link"""
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+@st.cache_data(show_spinner=False)
+def to_excel_bytes(df):
+    """Serialize a DataFrame to xlsx bytes, cached on the frame's content.
+
+    constant_memory is deliberately NOT used: pandas writes cells
+    column-major, and xlsxwriter's streaming mode drops writes to rows it
+    has already flushed, silently corrupting the sheet."""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+    with pd.ExcelWriter(output, engine='xlsxwriter',
+                        engine_kwargs={'options': {'strings_to_formulas': False}}) as writer:
         df.to_excel(writer, index=False)
-    excel_data = output.getvalue()
-    b64 = base64.b64encode(excel_data).decode()
-    return f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" download="{filename}.xlsx">{text}</a>'
+    return output.getvalue()
 
 # ======================
 # RECEIPT FUNCTIONS
 # ======================
-def generate_receipt_html(receipt_data):
-    """Generate HTML receipt"""
-    html = f"""
+# Static receipt markup lives at module level so each render only fills in
+# values; rows are joined in one pass instead of growing a string per item
+_RECEIPT_HEADER = """
     <div style="font-family: Arial, sans-serif; max-width: 800px; margin: 0 auto; padding: 20px; border: 1px solid #ddd; border-radius: 5px;">
         <div style="text-align: center; margin-bottom: 20px;">
             <h2>SUCCESS ACHIEVERS SCHOOL</h2>
@@ -327,13 +845,13 @@ def generate_receipt_html(receipt_data):
 
         <div style="display: flex; justify-content: space-between; margin-bottom: 20px;">
             <div>
-                <p><strong>Receipt #:</strong> {receipt_data['receipt_id']}</p>
-                <p><strong>Date:</strong> {receipt_data['date']}</p>
+                <p><strong>Receipt #:</strong> {receipt_id}</p>
+                <p><strong>Date:</strong> {date}</p>
             </div>
             <div>
-                <p><strong>Student:</strong> {receipt_data['customer_name'] or 'Walk-in Customer'}</p>
-                <p><strong>Payment Method:</strong> {receipt_data['payment_mode']}</p>
-                <p><strong>Reference:</strong> {receipt_data['reference'] or 'N/A'}</p>
+                <p><strong>Student:</strong> {customer_name}</p>
+                <p><strong>Payment Method:</strong> {payment_mode}</p>
+                <p><strong>Reference:</strong> {reference}</p>
             </div>
         </div>
 
@@ -348,33 +866,31 @@ def generate_receipt_html(receipt_data):
                 </tr>
             </thead>
             <tbody>
-    """
+"""
 
-    for item in receipt_data['items']:
-        amount = item['price'] * item['quantity']
-        html += f"""
+_RECEIPT_ROW = """
                 <tr>
-                    <td style="border: 1px solid #ddd; padding: 8px;">{item['name']}</td>
-                    <td style="border: 1px solid #ddd; padding: 8px;">{item['size']}</td>
-                    <td style="border: 1px solid #ddd; padding: 8px; text-align: right;">{format_currency(item['price'])}</td>
-                    <td style="border: 1px solid #ddd; padding: 8px; text-align: right;">{item['quantity']}</td>
-                    <td style="border: 1px solid #ddd; padding: 8px; text-align: right;">{format_currency(amount)}</td>
+                    <td style="border: 1px solid #ddd; padding: 8px;">{name}</td>
+                    <td style="border: 1px solid #ddd; padding: 8px;">{size}</td>
+                    <td style="border: 1px solid #ddd; padding: 8px; text-align: right;">{price}</td>
+                    <td style="border: 1px solid #ddd; padding: 8px; text-align: right;">{quantity}</td>
+                    <td style="border: 1px solid #ddd; padding: 8px; text-align: right;">{amount}</td>
                 </tr>
-        """
+"""
 
-    html += f"""
+_RECEIPT_FOOTER = """
             </tbody>
             <tfoot>
                 <tr>
                     <td colspan="4" style="border: 1px solid #ddd; padding: 8px; text-align: right;"><strong>Total:</strong></td>
-                    <td style="border: 1px solid #ddd; padding: 8px; text-align: right;"><strong>{format_currency(receipt_data['total_amount'])}</strong></td>
+                    <td style="border: 1px solid #ddd; padding: 8px; text-align: right;"><strong>{total_amount}</strong></td>
                 </tr>
             </tfoot>
         </table>
 
         <div style="margin-top: 30px; text-align: right;">
-            <p><strong>Issued By:</strong> {receipt_data['issued_by']}</p>
-            <p style="font-size: 0.9em; color: #666;">{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
+            <p><strong>Issued By:</strong> {issued_by}</p>
+            <p style="font-size: 0.9em; color: #666;">{timestamp}</p>
         </div>
 
         <div style="text-align: center; margin-top: 40px; font-size: 0.8em; color: #777;">
@@ -382,13 +898,37 @@ def generate_receipt_html(receipt_data):
             <p>This is a computer-generated receipt</p>
         </div>
     </div>
-    """
-    return html
+"""
+
+def generate_receipt_html(receipt_data):
+    """Generate HTML receipt"""
+    parts = [_RECEIPT_HEADER.format(
+        receipt_id=receipt_data['receipt_id'],
+        date=receipt_data['date'],
+        customer_name=receipt_data['customer_name'] or 'Walk-in Customer',
+        payment_mode=receipt_data['payment_mode'],
+        reference=receipt_data['reference'] or 'N/A'
+    )]
 
-def save_receipt(conn, receipt_data):
+    for item in receipt_data['items']:
+        parts.append(_RECEIPT_ROW.format(
+            name=item['name'],
+            size=item['size'],
+            price=format_currency(item['price']),
+            quantity=item['quantity'],
+            amount=format_currency(item['price'] * item['quantity'])
+        ))
+
+    parts.append(_RECEIPT_FOOTER.format(
+        total_amount=format_currency(receipt_data['total_amount']),
+        issued_by=receipt_data['issued_by'],
+        timestamp=datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    ))
+    return "".join(parts)
+
+def save_receipt(receipt_data):
     """Save receipt to database"""
     try:
-        items_json = json.dumps(receipt_data['items'])
         query = """
             INSERT INTO receipts (
                 receipt_id, date, customer_name, items_json,
@@ -399,13 +939,15 @@ def save_receipt(conn, receipt_data):
             receipt_data['receipt_id'],
             receipt_data['date'],
             receipt_data['customer_name'],
-            items_json,
+            Json(receipt_data['items']),
             receipt_data['total_amount'],
             receipt_data['payment_mode'],
             receipt_data['reference'],
             receipt_data['issued_by']
         )
-        return execute_query(conn, query, params)
+        # Receipt persistence doesn't gate the sale, so it runs in the background
+        submit_background_write(query, params)
+        return True
     except Exception as e:
         st.error(f"Failed to save receipt: {str(e)}")
         st.code(traceback.format_exc())
@@ -414,41 +956,290 @@ def save_receipt(conn, receipt_data):
 # ======================
 # STOCK MANAGEMENT
 # ======================
-def check_stock_availability(conn, item, size, quantity):
-    """Check if sufficient stock exists"""
+def record_sale(conn, sale_date, student_name, student_class, item, size,
+                quantity, price, payment_mode, reference, receipt_id):
+    """Insert a sale and decrement its stock in one atomic statement.
+
+    The CTE decrements stock only when enough exists, and the INSERT fires
+    only when the CTE updated a row — one round-trip, no TOCTOU window
+    between availability check and sale, no partial writes to unwind."""
     query = """
-        SELECT quantity FROM uniform_stock
-        WHERE item = %s AND size = %s AND quantity >= %s
+        WITH stock_update AS (
+            UPDATE uniform_stock
+            SET quantity = quantity - %s, last_updated = CURRENT_TIMESTAMP
+            WHERE item = %s AND size = %s AND quantity >= %s
+            RETURNING id
+        )
+        INSERT INTO uniform_sales (
+            date, student_name, student_class, item, size,
+            quantity, selling_price, payment_mode, reference, receipt_id
+        )
+        SELECT %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+        WHERE EXISTS (SELECT 1 FROM stock_update)
+        RETURNING receipt_id
     """
-    result = execute_query(conn, query, (item, size, quantity), fetch=True)
+    params = (
+        quantity, item, size, quantity,
+        sale_date, student_name, student_class, item, size,
+        quantity, price, payment_mode, reference, receipt_id
+    )
+    result = execute_query(conn, query, params, fetch=True, commit=True)
     return bool(result)
 
-def update_stock(conn, item, size, quantity_change):
-    """Update stock quantity"""
+# ======================
+# CACHED LIST QUERIES
+# ======================
+# These back the record tables on the Expenses/Stock/Sales tabs. Reruns with
+# unchanged filters hit the in-memory cache instead of the database; every
+# successful write calls st.cache_data.clear() so stale rows never linger
+# past a form submit.
+
+# Rows shown per page on the Expenses and Sales record tables
+PAGE_SIZE = 500
+
+def read_sql_df(conn, query, params=None):
+    """Fetch a query straight into a DataFrame.
+
+    pd.read_sql_query builds columns directly from the driver's rows,
+    skipping the intermediate list-of-dicts that pd.DataFrame(rows) copies
+    column by column."""
+    if not is_connection_active(conn):
+        conn = get_db_connection(force_reconnect=True)
+        if not conn:
+            return pd.DataFrame()
+    try:
+        return pd.read_sql_query(query, conn, params=params)
+    except Exception as e:
+        if is_connection_active(conn):
+            conn.rollback()
+        st.error(f"Database error: {e}")
+        return pd.DataFrame()
+
+@st.cache_data(show_spinner=False, hash_funcs={
+    pd.DataFrame: lambda d: pd.util.hash_pandas_object(d, index=True).values.tobytes()
+})
+def build_category_pie(df, values, names, title):
+    """Category pie figure, memoized on frame content.
+
+    Plotly rebuilds and re-serializes a figure from scratch on every
+    call; hashing the input frame lets unchanged aggregates reuse the
+    same figure object across reruns."""
+    # Deferred: plotly costs ~500ms to import and only pies use it now
+    import plotly.express as px
+    return px.pie(df, values=values, names=names, title=title)
+
+def read_sql_df_chunked(conn, query, params=None, itersize=50000):
+    """Fetch an unbounded result through a server-side cursor.
+
+    A named cursor streams itersize rows at a time, so full exports hold
+    one chunk in client memory instead of the whole set twice (driver
+    rows + DataFrame)."""
+    if not is_connection_active(conn):
+        conn = get_db_connection(force_reconnect=True)
+        if not conn:
+            return pd.DataFrame()
+    try:
+        with conn.cursor(name=f"export_{uuid.uuid4().hex}") as cursor:
+            cursor.itersize = itersize
+            cursor.execute(query, params)
+            columns = [desc[0] for desc in cursor.description]
+            df = pd.DataFrame.from_records(iter(cursor), columns=columns)
+        conn.commit()
+        return df
+    except Exception as e:
+        if is_connection_active(conn):
+            conn.rollback()
+        st.error(f"Database error: {e}")
+        return pd.DataFrame()
+
+@lru_cache(maxsize=8)
+def _expense_clause_sql(has_categories, has_term):
+    """Clause text for an expense filter shape, memoized per shape"""
+    clause = " WHERE date BETWEEN %s AND %s"
+    if has_categories:
+        # = ANY keeps the query text identical regardless of how many
+        # categories are picked, so Postgres can reuse one plan
+        clause += " AND category = ANY(%s)"
+    if has_term:
+        clause += " AND description ILIKE %s"
+    return clause
+
+@lru_cache(maxsize=8)
+def _sales_clause_sql(has_items, has_term):
+    """Clause text for a sales filter shape, memoized per shape"""
+    clause = " WHERE date BETWEEN %s AND %s"
+    if has_items:
+        clause += " AND item = ANY(%s)"
+    if has_term:
+        clause += " AND (student_name ILIKE %s OR reference ILIKE %s)"
+    return clause
+
+def _expense_filter_clause(start_date, end_date, categories, search_term):
+    """Shared WHERE clause for the expense list and its totals query"""
+    params = [start_date, end_date]
+    if categories:
+        params.append(list(categories))
+    if search_term:
+        params.append(f"%{search_term}%")
+    return _expense_clause_sql(bool(categories), bool(search_term)), params
+
+def _sales_filter_clause(start_date, end_date, items, search_term):
+    """Shared WHERE clause for the sales list and its totals query"""
+    params = [start_date, end_date]
+    if items:
+        params.append(list(items))
+    if search_term:
+        params.extend([f"%{search_term}%", f"%{search_term}%"])
+    return _sales_clause_sql(bool(items), bool(search_term)), params
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_expense_records(_conn, start_date, end_date, categories, search_term, page=None):
+    """Filtered expense rows as a DataFrame (categories must be a tuple).
+
+    page=None fetches everything (exports); otherwise one PAGE_SIZE slice."""
+    clause, params = _expense_filter_clause(start_date, end_date, categories, search_term)
+    query = "SELECT date, category, description, amount, receipt_no FROM expenses" + clause
+    query += " ORDER BY date DESC"
+
+    if page is not None:
+        query += " LIMIT %s OFFSET %s"
+        params.extend([PAGE_SIZE, (page - 1) * PAGE_SIZE])
+        df = read_sql_df(_conn, query, params)
+    else:
+        # Exports are unbounded — stream them server-side
+        df = read_sql_df_chunked(_conn, query, params)
+
+    if df.empty:
+        return df
+    df.columns = ["Date", "Category", "Description", "Amount", "Receipt No"]
+    # Compact dtypes: NUMERIC arrives as Decimal objects; int32 halves the
+    # quantity bytes and categoricals dictionary-encode the repeated labels
+    # in the Arrow payload. Money stays float64 — float32 loses cents above
+    # ~131,072, and these frames feed the CSV/Excel exports
+    return df.astype({"Amount": "float64", "Category": "category"})
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_expense_totals(_conn, start_date, end_date, categories, search_term):
+    """Row count and amount sum for the current expense filters"""
+    clause, params = _expense_filter_clause(start_date, end_date, categories, search_term)
+    query = "SELECT COUNT(*) as row_count, COALESCE(SUM(amount), 0) as total_amount FROM expenses" + clause
+    result = execute_query(_conn, query, params, fetch=True)
+    return result[0] if result else {'row_count': 0, 'total_amount': 0}
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_sales_records(_conn, start_date, end_date, items, search_term, page=None):
+    """Filtered sales rows as a DataFrame (items must be a tuple).
+
+    page=None fetches everything (exports); otherwise one PAGE_SIZE slice."""
+    clause, params = _sales_filter_clause(start_date, end_date, items, search_term)
     query = """
-        UPDATE uniform_stock
-        SET quantity = quantity + %s, last_updated = CURRENT_TIMESTAMP
-        WHERE item = %s AND size = %s
-    """
-    return execute_query(conn, query, (quantity_change, item, size))
+        SELECT date, student_name, student_class, item, size,
+               quantity, selling_price, quantity * selling_price as total,
+               payment_mode, reference, receipt_id
+        FROM uniform_sales
+    """ + clause
+    query += " ORDER BY date DESC"
+
+    if page is not None:
+        query += " LIMIT %s OFFSET %s"
+        params.extend([PAGE_SIZE, (page - 1) * PAGE_SIZE])
+        df = read_sql_df(_conn, query, params)
+    else:
+        # Exports are unbounded — stream them server-side
+        df = read_sql_df_chunked(_conn, query, params)
+
+    if df.empty:
+        return df
+    df.columns = [
+        "Date", "Student", "Class", "Item", "Size",
+        "Quantity", "Price", "Total", "Payment", "Reference", "Receipt ID"
+    ]
+    return df.astype({"Quantity": "int32", "Price": "float64", "Total": "float64",
+                      "Item": "category", "Payment": "category"})
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_sales_totals(_conn, start_date, end_date, items, search_term):
+    """Row count, revenue sum and quantity sum for the current sales filters"""
+    clause, params = _sales_filter_clause(start_date, end_date, items, search_term)
+    query = """
+        SELECT COUNT(*) as row_count,
+               COALESCE(SUM(quantity * selling_price), 0) as total_sales,
+               COALESCE(SUM(quantity), 0) as total_items
+        FROM uniform_sales
+    """ + clause
+    result = execute_query(_conn, query, params, fetch=True)
+    return result[0] if result else {'row_count': 0, 'total_sales': 0, 'total_items': 0}
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_dashboard_headline(_conn, month_start, year_start):
+    """Month and year-to-date headline totals as one cached row.
+
+    All five aggregates ride in one statement and conditional SUMs derive
+    the month totals from the same year-to-date scan, so each table is
+    read once — and tab switches within the TTL cost no queries at all."""
+    result = run_dashboard_query(_conn, 'dashboard_headline',
+                                 {'month_start': month_start, 'year_start': year_start})
+    return result[0] if result else {}
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_stock_totals(_conn):
+    """Item count and stock valuation, aggregated server-side"""
+    result = run_dashboard_query(_conn, 'stock_totals')
+    return result[0] if result else {'total_items': 0, 'total_value': 0}
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_dashboard_details(_conn, month_start):
+    """The dashboard's non-headline sections as one cached bundle.
+
+    Keyed by month so a new month naturally gets fresh rows; writes clear
+    the cache (directly or via LISTEN/NOTIFY), so within a month these only
+    hit the database after actual changes."""
+    return {
+        'recent_expenses': execute_query(_conn,
+            "SELECT date, category, description, amount FROM expenses ORDER BY date DESC LIMIT 5",
+            fetch=True),
+        'recent_sales': execute_query(_conn,
+            """SELECT date, item, size, quantity, selling_price,
+               (quantity * selling_price) as total, student_name
+               FROM uniform_sales ORDER BY created_at DESC LIMIT 5""",
+            fetch=True),
+        'categories': run_dashboard_query(_conn, 'dashboard_categories',
+                                          {'month_start': month_start}),
+        'top_items': run_dashboard_query(_conn, 'dashboard_top_items',
+                                         {'month_start': month_start}),
+        'low_stock': run_dashboard_query(_conn, 'dashboard_low_stock'),
+    }
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_stock_levels(_conn):
+    """Current stock levels as a DataFrame"""
+    df = read_sql_df(_conn, """
+        SELECT item, size, quantity, unit_cost, quantity * unit_cost as total_value
+        FROM uniform_stock ORDER BY item, size
+    """)
+    if df.empty:
+        return df
+    df.columns = ["Item", "Size", "Quantity", "Unit Cost", "Total Value"]
+    return df.astype({"Quantity": "int32", "Unit Cost": "float64",
+                      "Total Value": "float64", "Item": "category"})
 
 # ======================
 # APPLICATION PAGES
 # ======================
+@st.fragment
 def show_expenses_tab(conn):
     """Expenses management tab"""
+    today = date.today()
+
     st.header("💰 Expense Management")
 
     with st.expander("➕ Add New Expense", expanded=True):
         with st.form("expense_form", clear_on_submit=True):
             cols = st.columns(3)
             with cols[0]:
-                exp_date = st.date_input("Date", value=date.today())
+                exp_date = st.date_input("Date", value=today)
             with cols[1]:
-                category = st.selectbox("Category", [
-                    "Stationery", "Food", "Fuel", "Maintenance",
-                    "Salaries", "Utilities", "Transport", "Events","Mechanic", "Other"
-                ])
+                category = st.selectbox("Category", EXPENSE_CATEGORIES)
             with cols[2]:
                 amount = st.number_input("Amount (KES)", min_value=0.0, step=0.01, format="%.2f")
 
@@ -462,55 +1253,61 @@ def show_expenses_tab(conn):
                         VALUES (%s, %s, %s, %s, %s)
                     """
                     if execute_query(conn, query, (exp_date, category, description, amount, receipt_no)):
+                        st.cache_data.clear()
+                        refresh_monthly_financials()
                         st.success("Expense recorded successfully!")
                         st.rerun()
                 else:
                     st.warning("Please enter a valid amount and description")
 
     st.subheader("🔍 Expense Records")
+    # A form batches filter edits into one rerun on Apply instead of
+    # re-querying after every keystroke/selection
     with st.expander("Filter Expenses"):
-        cols = st.columns(3)
-        with cols[0]:
-            start_date = st.date_input("From", value=date.today() - timedelta(days=30))
-        with cols[1]:
-            end_date = st.date_input("To", value=date.today())
-        with cols[2]:
-            categories = st.multiselect("Categories", [
-                "Stationery", "Food", "Fuel", "Maintenance",
-                "Salaries", "Utilities", "Transport", "Events","Mechanic", "Other"
-            ])
-
-        search_term = st.text_input("Search Description")
-
-    # Build query
-    query = "SELECT date, category, description, amount, receipt_no FROM expenses WHERE date BETWEEN %s AND %s"
-    params = [start_date, end_date]
+        with st.form("expense_filters"):
+            cols = st.columns(3)
+            with cols[0]:
+                start_date = st.date_input("From", value=today - timedelta(days=30))
+            with cols[1]:
+                end_date = st.date_input("To", value=today)
+            with cols[2]:
+                categories = st.multiselect("Categories", EXPENSE_CATEGORIES)
 
-    if categories:
-        query += " AND category IN (" + ",".join(["%s"] * len(categories)) + ")"
-        params.extend(categories)
+            search_term = st.text_input("Search Description")
+            st.form_submit_button("Apply Filters")
 
-    if search_term:
-        query += " AND description ILIKE %s"
-        params.append(f"%{search_term}%")
+    totals = fetch_expense_totals(conn, start_date, end_date, tuple(categories), search_term)
+    row_count = totals['row_count']
 
-    query += " ORDER BY date DESC" # Changed to ORDER BY date DESC for robustness
+    if row_count:
+        # Totals come from the database, so the table itself only needs the
+        # page being looked at
+        max_page = (row_count - 1) // PAGE_SIZE + 1
+        page = 1
+        if max_page > 1:
+            page = st.number_input("Page", min_value=1, max_value=max_page, step=1, value=1)
 
-    expenses = execute_query(conn, query, params, fetch=True)
-    if expenses:
-        df = pd.DataFrame(expenses, columns=["Date", "Category", "Description", "Amount", "Receipt No"])
-        st.dataframe(df, use_container_width=True)
+        df = fetch_expense_records(conn, start_date, end_date, tuple(categories), search_term, page)
+        # Format in the grid instead of building display-string columns
+        st.dataframe(df, use_container_width=True, hide_index=True, column_config={
+            "Amount": st.column_config.NumberColumn(format="KES %.2f")
+        })
 
         # Summary stats
-        total_expenses = df['Amount'].sum()
-        st.metric("Total Expenses", format_currency(total_expenses))
-
-        # Download options
-        st.markdown(get_download_link(df, "expenses_report", "📥 Download as CSV"), unsafe_allow_html=True)
-        st.markdown(get_excel_link(df, "expenses_report", "📊 Download as Excel"), unsafe_allow_html=True)
+        st.metric("Total Expenses", format_currency(totals['total_amount']))
+        st.caption(f"{row_count:,} records")
+
+        # Download options (full unpaginated fetch, only when requested)
+        if st.checkbox("Prepare full export", key="expenses_export"):
+            full_df = fetch_expense_records(conn, start_date, end_date, tuple(categories), search_term)
+            st.download_button("📥 Download as CSV", data=to_csv_bytes(full_df),
+                               file_name="expenses_report.csv", mime="text/csv")
+            st.download_button("📊 Download as Excel", data=to_excel_bytes(full_df),
+                               file_name="expenses_report.xlsx", mime=EXCEL_MIME)
     else:
         st.info("No expenses found for the selected filters")
 
+@st.fragment
 def show_stock_tab(conn):
     """Uniform stock management tab"""
     st.header("👕 Uniform Stock Management")
@@ -519,10 +1316,7 @@ def show_stock_tab(conn):
         with st.form("stock_form", clear_on_submit=True):
             cols = st.columns([2, 1, 1, 2])
             with cols[0]:
-                item = st.selectbox("Item", [
-                    "Sweater", "Tracksuit", "Dress", "T-shirt",
-                    "Trousers", "Shirt", "Tie", "Socks", "Blazer", "PE Kit"
-                ])
+                item = st.selectbox("Item", UNIFORM_ITEMS)
             with cols[1]:
                 size = st.text_input("Size", placeholder="e.g., M, 12, etc.", max_chars=50).upper()
             with cols[2]:
@@ -538,63 +1332,60 @@ def show_stock_tab(conn):
 
             if st.form_submit_button("Update Stock", type="primary"):
                 if size.strip():
-                    # Check if item exists
-                    check_query = "SELECT id FROM uniform_stock WHERE item = %s AND size = %s"
-                    exists = execute_query(conn, check_query, (item, size), fetch=True)
-
-                    if exists:
-                        # Update existing stock
-                        update_query = """
-                            UPDATE uniform_stock
-                            SET quantity = quantity + %s, unit_cost = %s, supplier = %s, invoice_no = %s, last_updated = CURRENT_TIMESTAMP
-                            WHERE item = %s AND size = %s
-                        """
-                        if execute_query(conn, update_query,
-                                       (quantity, unit_cost, supplier, invoice_no, item, size)):
-                            st.success("Stock updated successfully!")
-                            st.rerun()
-                    else:
-                        # Add new stock
-                        insert_query = """
-                            INSERT INTO uniform_stock (item, size, quantity, unit_cost, supplier, invoice_no)
-                            VALUES (%s, %s, %s, %s, %s, %s)
-                        """
-                        if execute_query(conn, insert_query,
-                                       (item, size, quantity, unit_cost, supplier, invoice_no)):
-                            st.success("New stock item added!")
-                            st.rerun()
+                    # Single atomic upsert — no SELECT-then-branch round-trip
+                    # and no race window between check and write
+                    upsert_query = """
+                        INSERT INTO uniform_stock (item, size, quantity, unit_cost, supplier, invoice_no)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (item, size) DO UPDATE SET
+                            quantity = uniform_stock.quantity + EXCLUDED.quantity,
+                            unit_cost = EXCLUDED.unit_cost,
+                            supplier = EXCLUDED.supplier,
+                            invoice_no = EXCLUDED.invoice_no,
+                            last_updated = CURRENT_TIMESTAMP
+                    """
+                    if execute_query(conn, upsert_query,
+                                   (item, size, quantity, unit_cost, supplier, invoice_no)):
+                        st.cache_data.clear()
+                        st.success("Stock updated successfully!")
+                        st.rerun()
                 else:
                     st.warning("Please enter a valid size")
 
     st.subheader("📊 Current Stock Levels")
-    stock = execute_query(conn, "SELECT item, size, quantity, unit_cost FROM uniform_stock ORDER BY item, size", fetch=True)
-    if stock:
-        df = pd.DataFrame(stock, columns=["Item", "Size", "Quantity", "Unit Cost"])
-        df["Total Value"] = df["Quantity"] * df["Unit Cost"]
-
-        # Show summary
-        total_items = df["Quantity"].sum()
-        total_value = df["Total Value"].sum()
+    df = fetch_stock_levels(conn)
+    if not df.empty:
+        # Summary metrics aggregate in SQL rather than over the fetched frame
+        stock_totals = fetch_stock_totals(conn)
 
         cols = st.columns(2)
-        cols[0].metric("Total Items in Stock", f"{total_items:,}")
-        cols[1].metric("Total Stock Value", format_currency(total_value))
-
-        st.dataframe(df, use_container_width=True)
-        st.markdown(get_download_link(df, "stock_report", "📥 Download Stock Report CSV"), unsafe_allow_html=True)
-        st.markdown(get_excel_link(df, "stock_report", "📊 Download Stock Report Excel"), unsafe_allow_html=True)
+        cols[0].metric("Total Items in Stock", f"{stock_totals['total_items']:,}")
+        cols[1].metric("Total Stock Value", format_currency(stock_totals['total_value']))
+
+        st.dataframe(df, use_container_width=True, hide_index=True, column_config={
+            "Unit Cost": st.column_config.NumberColumn(format="KES %.2f"),
+            "Total Value": st.column_config.NumberColumn(format="KES %.2f")
+        })
+        st.download_button("📥 Download Stock Report CSV", data=to_csv_bytes(df),
+                           file_name="stock_report.csv", mime="text/csv")
+        st.download_button("📊 Download Stock Report Excel", data=to_excel_bytes(df),
+                           file_name="stock_report.xlsx", mime=EXCEL_MIME)
     else:
         st.info("No stock items found in inventory")
 
+@st.fragment
 def show_sales_tab(conn):
     """Uniform sales management tab"""
+    today = date.today()
+    username = st.session_state.get("username", "System")
+
     st.header("🛍 Uniform Sales")
 
     with st.expander("💳 Record New Sale", expanded=True):
         with st.form("sales_form", clear_on_submit=True):
             cols = st.columns(3)
             with cols[0]:
-                sale_date = st.date_input("Date", value=date.today())
+                sale_date = st.date_input("Date", value=today)
             with cols[1]:
                 student_name = st.text_input("Student Name (optional)", max_chars=255)
             with cols[2]:
@@ -602,10 +1393,7 @@ def show_sales_tab(conn):
 
             cols = st.columns([2, 1, 1, 2])
             with cols[0]:
-                item = st.selectbox("Item", [
-                    "Sweater", "Tracksuit", "Dress", "T-shirt",
-                    "Trousers", "Shirt", "Tie", "Socks", "Blazer", "PE Kit"
-                ])
+                item = st.selectbox("Item", UNIFORM_ITEMS)
             with cols[1]:
                 size = st.text_input("Size", max_chars=50).upper()
             with cols[2]:
@@ -615,7 +1403,7 @@ def show_sales_tab(conn):
 
             cols = st.columns(2)
             with cols[0]:
-                payment_mode = st.selectbox("Payment Method", ["Cash", "M-Pesa", "Bank Transfer", "Cheque", "Other"])
+                payment_mode = st.selectbox("Payment Method", PAYMENT_MODES)
             with cols[1]:
                 reference = st.text_input("Payment Reference (optional)", max_chars=255)
 
@@ -623,123 +1411,163 @@ def show_sales_tab(conn):
 
             if st.form_submit_button("Record Sale", type="primary"):
                 if size.strip() and price > 0 and quantity > 0:
-                    # Check stock availability
-                    if not check_stock_availability(conn, item, size, quantity):
+                    # Generate receipt ID
+                    receipt_id = generate_unique_id("REC-")
+
+                    # Sale insert and stock decrement happen in one atomic
+                    # statement; a falsy result means insufficient stock
+                    if not record_sale(conn, sale_date, student_name, student_class,
+                                       item, size, quantity, price, payment_mode,
+                                       reference, receipt_id):
                         st.error(f"Insufficient stock for {item} (Size: {size}). Please check inventory.")
                     else:
-                        # Generate receipt ID
-                        receipt_id = generate_unique_id("REC-")
-
-                        # Record sale
-                        sale_query = """
-                            INSERT INTO uniform_sales (
-                                date, student_name, student_class, item, size,
-                                quantity, selling_price, payment_mode, reference, receipt_id
-                            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        """
-                        sale_params = (
-                            sale_date, student_name, student_class, item, size,
-                            quantity, price, payment_mode, reference, receipt_id
-                        )
-
-                        if execute_query(conn, sale_query, sale_params):
-                            # Update stock
-                            update_stock(conn, item, size, -quantity)
-                            st.success("Sale recorded successfully!")
-
-                            # Generate receipt if requested
-                            if generate_receipt:
-                                receipt_data = {
+                        st.cache_data.clear()
+                        refresh_monthly_financials()
+                        st.success("Sale recorded successfully!")
+
+                        # Generate receipt if requested
+                        if generate_receipt:
+                            receipt_data = {
+                                "receipt_id": receipt_id,
+                                "date": sale_date.strftime("%Y-%m-%d"),
+                                "customer_name": student_name or "Walk-in Customer",
+                                "items": [{
+                                    "name": item,
+                                    "size": size,
+                                    "price": price,
+                                    "quantity": quantity
+                                }],
+                                "total_amount": float(price * quantity),
+                                "payment_mode": payment_mode,
+                                "reference": reference,
+                                "issued_by": username
+                            }
+
+                            # Stash the rendered receipt so it survives the
+                            # rerun and renders OUTSIDE the form — download
+                            # buttons aren't allowed inside st.form
+                            if save_receipt(receipt_data):
+                                st.session_state.last_receipt = {
                                     "receipt_id": receipt_id,
-                                    "date": sale_date.strftime("%Y-%m-%d"),
-                                    "customer_name": student_name or "Walk-in Customer",
-                                    "items": [{
-                                        "name": item,
-                                        "size": size,
-                                        "price": price,
-                                        "quantity": quantity
-                                    }],
-                                    "total_amount": float(price * quantity),
-                                    "payment_mode": payment_mode,
-                                    "reference": reference,
-                                    "issued_by": st.session_state.get("username", "System")
+                                    "html": generate_receipt_html(receipt_data)
                                 }
-
-                                # Save receipt
-                                if save_receipt(conn, receipt_data):
-                                    # Show receipt
-                                    st.subheader("Generated Receipt")
-                                    receipt_html = generate_receipt_html(receipt_data)
-                                    with st.expander("📄 View Receipt", expanded=True):
-                                        st.components.v1.html(receipt_html, height=600)
-                                        # Download button for HTML receipt
-                                        st.markdown(
-                                            f'<a href="data:text/html;base64,{base64.b64encode(receipt_html.encode()).decode()}" '
-                                            f'download="receipt_{receipt_id}.html" target="_blank">📄 Download Receipt HTML</a>',
-                                            unsafe_allow_html=True
-                                        )
-                            st.rerun()
+                        st.rerun()
                 else:
                     st.warning("Please ensure Size, Quantity, and Unit Price are valid and entered.")
 
+    last_receipt = st.session_state.get("last_receipt")
+    if last_receipt:
+        st.subheader("Generated Receipt")
+        with st.expander("📄 View Receipt", expanded=True):
+            st.components.v1.html(last_receipt["html"], height=600)
+            # Bytes only cross the wire on click —
+            # no base64 blob inflating the page DOM
+            st.download_button(
+                "📄 Download Receipt HTML",
+                data=last_receipt["html"].encode(),
+                file_name=f"receipt_{last_receipt['receipt_id']}.html",
+                mime="text/html",
+                key=f"dl_{last_receipt['receipt_id']}"
+            )
+            if st.button("Dismiss receipt"):
+                del st.session_state.last_receipt
+                st.rerun()
+
     st.subheader("📋 Sales Records")
     with st.expander("Filter Sales"):
-        cols = st.columns(3)
-        with cols[0]:
-            start_date = st.date_input("From Date", value=date.today() - timedelta(days=30))
-        with cols[1]:
-            end_date = st.date_input("To Date", value=date.today())
-        with cols[2]:
-            items = st.multiselect("Items", [
-                "Sweater", "Tracksuit", "Dress", "T-shirt",
-                "Trousers", "Shirt", "Tie", "Socks", "Blazer", "PE Kit"
-            ])
+        with st.form("sales_filters"):
+            cols = st.columns(3)
+            with cols[0]:
+                start_date = st.date_input("From Date", value=today - timedelta(days=30))
+            with cols[1]:
+                end_date = st.date_input("To Date", value=today)
+            with cols[2]:
+                items = st.multiselect("Items", UNIFORM_ITEMS)
 
-        search_term = st.text_input("Search Student or Reference")
+            search_term = st.text_input("Search Student or Reference")
+            st.form_submit_button("Apply Filters")
 
-    # Build query
-    query = """
-        SELECT date, student_name, student_class, item, size,
-               quantity, selling_price, payment_mode, reference, receipt_id
-        FROM uniform_sales
-        WHERE date BETWEEN %s AND %s
-    """
-    params = [start_date, end_date]
+    totals = fetch_sales_totals(conn, start_date, end_date, tuple(items), search_term)
+    row_count = totals['row_count']
 
-    if items:
-        query += " AND item IN (" + ",".join(["%s"] * len(items)) + ")"
-        params.extend(items)
+    if row_count:
+        max_page = (row_count - 1) // PAGE_SIZE + 1
+        page = 1
+        if max_page > 1:
+            page = st.number_input("Page", min_value=1, max_value=max_page, step=1, value=1)
 
-    if search_term:
-        query += " AND (student_name ILIKE %s OR reference ILIKE %s)"
-        params.extend([f"%{search_term}%", f"%{search_term}%"])
+        df = fetch_sales_records(conn, start_date, end_date, tuple(items), search_term, page)
 
-    query += " ORDER BY date DESC"
+        # Summary stats come from the totals query, not the displayed page
+        cols = st.columns(2)
+        cols[0].metric("Total Sales", format_currency(totals['total_sales']))
+        cols[1].metric("Items Sold", f"{totals['total_items']:,}")
+
+        st.dataframe(df, use_container_width=True, hide_index=True, column_config={
+            "Price": st.column_config.NumberColumn(format="KES %.2f"),
+            "Total": st.column_config.NumberColumn(format="KES %.2f")
+        })
+        st.caption(f"{row_count:,} records")
+
+        if st.checkbox("Prepare full export", key="sales_export"):
+            full_df = fetch_sales_records(conn, start_date, end_date, tuple(items), search_term)
+            st.download_button("📥 Download Sales Report CSV", data=to_csv_bytes(full_df),
+                               file_name="sales_report.csv", mime="text/csv")
+            st.download_button("📊 Download Sales Report Excel", data=to_excel_bytes(full_df),
+                               file_name="sales_report.xlsx", mime=EXCEL_MIME)
+    else:
+        st.info("No sales found for the selected filters")
 
-    sales = execute_query(conn, query, params, fetch=True)
-    if sales:
-        df = pd.DataFrame(sales, columns=[
-            "Date", "Student", "Class", "Item", "Size",
-            "Quantity", "Price", "Payment", "Reference", "Receipt ID"
-        ])
-        df["Total"] = df["Quantity"] * df["Price"]
+@st.cache_data(persist="disk", show_spinner=False)
+def build_monthly_trends(_conn, start_date, view_fingerprint):
+    """Build the monthly trends DataFrame, persisted to disk.
+
+    view_fingerprint is a digest of the materialized view's own content
+    (see get_trends_fingerprint): the memo invalidates exactly when a
+    REFRESH lands, otherwise reruns are served from disk. Keying on base
+    tables instead would cache stale view rows under a fresh key while an
+    async refresh is still in flight."""
+    # The materialized view already holds one pre-aggregated row per month,
+    # so this reads O(months) rows instead of re-scanning both tables
+    query = """
+        SELECT month, expenses, sales, sales - expenses as net
+        FROM mv_monthly_financials
+        WHERE month >= %s
+        ORDER BY month
+    """
+    results = execute_query(_conn, query, (start_date,), fetch=True)
+    if not results:
+        return pd.DataFrame()
 
-        # Summary stats
-        total_sales = df["Total"].sum()
-        total_items = df["Quantity"].sum()
+    trend_df = pd.DataFrame(results)
+    trend_df.columns = ["Month", "Expenses", "Sales", "Net"]
+    trend_df["Month"] = pd.to_datetime(trend_df["Month"])
+    return trend_df
 
-        cols = st.columns(2)
-        cols[0].metric("Total Sales", format_currency(total_sales))
-        cols[1].metric("Items Sold", f"{total_items:,}")
+def get_trends_fingerprint(conn):
+    """Cache key for build_monthly_trends, derived from the view itself.
 
-        st.dataframe(df, use_container_width=True)
-        st.markdown(get_download_link(df, "sales_report", "📥 Download Sales Report CSV"), unsafe_allow_html=True)
-        st.markdown(get_excel_link(df, "sales_report", "📊 Download Sales Report Excel"), unsafe_allow_html=True)
-    else:
-        st.info("No sales found for the selected filters")
+    One cheap aggregate over the O(months) materialized view; it only
+    changes when a REFRESH actually lands, so the trends memo can never
+    cache pre-refresh rows under a post-refresh key."""
+    query = """
+        SELECT COUNT(*) as months,
+               COALESCE(MAX(month)::text, '') as last_month,
+               COALESCE(SUM(expenses), 0) as expenses,
+               COALESCE(SUM(sales), 0) as sales
+        FROM mv_monthly_financials
+    """
+    result = execute_query(conn, query, fetch=True)
+    if result:
+        row = result[0]
+        return f"{row['months']}:{row['last_month']}:{row['expenses']}:{row['sales']}"
+    return ""
 
+@st.fragment
 def show_reports_tab(conn):
     """Financial reports tab"""
+    today = date.today()
+
     st.header("📈 Financial Reports")
 
     report_type = st.selectbox("Select Report Type", [
@@ -753,9 +1581,9 @@ def show_reports_tab(conn):
         st.subheader("💰 Expense Summary Report")
         cols = st.columns(2)
         with cols[0]:
-            start_date = st.date_input("Start Date", value=date.today().replace(day=1))
+            start_date = st.date_input("Start Date", value=today.replace(day=1))
         with cols[1]:
-            end_date = st.date_input("End Date", value=date.today())
+            end_date = st.date_input("End Date", value=today)
 
         query = """
             SELECT category, SUM(amount) as total
@@ -774,12 +1602,13 @@ def show_reports_tab(conn):
 
             cols = st.columns(2)
             with cols[0]:
-                st.dataframe(df, use_container_width=True)
+                st.dataframe(df, use_container_width=True, hide_index=True)
             with cols[1]:
-                fig = px.pie(df, values="Amount", names="Category",
-                            title="Expense Distribution")
+                fig = build_category_pie(df, "Amount", "Category",
+                                         "Expense Distribution")
                 st.plotly_chart(fig, use_container_width=True)
-            st.markdown(get_download_link(df, "expense_summary", "📥 Download CSV"), unsafe_allow_html=True)
+            st.download_button("📥 Download CSV", data=to_csv_bytes(df),
+                               file_name="expense_summary.csv", mime="text/csv")
         else:
             st.info("No expenses found for the selected period")
 
@@ -787,9 +1616,9 @@ def show_reports_tab(conn):
         st.subheader("🛍 Sales Summary Report")
         cols = st.columns(2)
         with cols[0]:
-            start_date = st.date_input("Start Date", value=date.today().replace(day=1))
+            start_date = st.date_input("Start Date", value=today.replace(day=1))
         with cols[1]:
-            end_date = st.date_input("End Date", value=date.today())
+            end_date = st.date_input("End Date", value=today)
 
         query = """
             SELECT item, SUM(quantity) as total_qty, SUM(quantity * selling_price) as total_sales
@@ -811,14 +1640,14 @@ def show_reports_tab(conn):
 
             cols = st.columns(2)
             with cols[0]:
-                st.dataframe(df, use_container_width=True)
+                st.dataframe(df, use_container_width=True, hide_index=True)
             with cols[1]:
-                fig = px.bar(df, x="Item", y="Total Sales", 
-                           title="Sales by Item Category")
-                fig.update_xaxes(tickangle=45)
-                st.plotly_chart(fig, use_container_width=True)
+                # Native Vega-Lite chart: far lighter payload than Plotly
+                # JSON and diffs cheaply across reruns
+                st.bar_chart(df.set_index("Item")["Total Sales"])
 
-            st.markdown(get_download_link(df, "sales_summary", "📥 Download CSV"), unsafe_allow_html=True)
+            st.download_button("📥 Download CSV", data=to_csv_bytes(df),
+                               file_name="sales_summary.csv", mime="text/csv")
         else:
             st.info("No sales found for the selected period")
 
@@ -843,15 +1672,17 @@ def show_reports_tab(conn):
             cols[1].metric("Total Items", f"{total_items:,}")
             cols[2].metric("Average Item Value", format_currency(total_inventory_value / total_items if total_items > 0 else 0))
 
-            st.dataframe(df, use_container_width=True)
+            # Per-SKU rows grow unbounded; cap the rendered viewport
+            st.dataframe(df, use_container_width=True, hide_index=True, height=400)
 
             # Low stock alert
             low_stock = df[df["Quantity"] <= 5]
             if not low_stock.empty:
                 st.warning("⚠️ Low Stock Alert")
-                st.dataframe(low_stock, use_container_width=True)
+                st.dataframe(low_stock, use_container_width=True, hide_index=True)
 
-            st.markdown(get_download_link(df, "inventory_valuation", "📥 Download CSV"), unsafe_allow_html=True)
+            st.download_button("📥 Download CSV", data=to_csv_bytes(df),
+                               file_name="inventory_valuation.csv", mime="text/csv")
         else:
             st.info("No inventory items found")
 
@@ -859,75 +1690,38 @@ def show_reports_tab(conn):
         st.subheader("📊 Monthly Trends Analysis")
         
         # Get last 12 months data
-        end_date = date.today()
+        end_date = today
         start_date = end_date.replace(year=end_date.year - 1)
 
-        # Expenses trend
-        expense_query = """
-            SELECT DATE_TRUNC('month', date) as month, SUM(amount) as total_expenses
-            FROM expenses
-            WHERE date >= %s
-            GROUP BY month
-            ORDER BY month
-        """
-        expense_results = execute_query(conn, expense_query, (start_date,), fetch=True)
-
-        # Sales trend
-        sales_query = """
-            SELECT DATE_TRUNC('month', date) as month, SUM(quantity * selling_price) as total_sales
-            FROM uniform_sales
-            WHERE date >= %s
-            GROUP BY month
-            ORDER BY month
-        """
-        sales_results = execute_query(conn, sales_query, (start_date,), fetch=True)
-
-        if expense_results or sales_results:
-            # Create combined dataframe
-            expense_df = pd.DataFrame(expense_results, columns=["Month", "Expenses"]) if expense_results else pd.DataFrame(columns=["Month", "Expenses"])
-            sales_df = pd.DataFrame(sales_results, columns=["Month", "Sales"]) if sales_results else pd.DataFrame(columns=["Month", "Sales"])
-
-            # Merge dataframes
-            if not expense_df.empty and not sales_df.empty:
-                trend_df = pd.merge(expense_df, sales_df, on="Month", how="outer")
-            elif not expense_df.empty:
-                trend_df = expense_df.copy()
-                trend_df["Sales"] = 0
-            elif not sales_df.empty:
-                trend_df = sales_df.copy()
-                trend_df["Expenses"] = 0
-            else:
-                trend_df = pd.DataFrame()
+        trend_df = build_monthly_trends(conn, start_date, get_trends_fingerprint(conn))
 
-            if not trend_df.empty:
-                trend_df = trend_df.fillna(0)
-                trend_df["Month"] = pd.to_datetime(trend_df["Month"])
-                trend_df["Net"] = trend_df["Sales"] - trend_df["Expenses"]
-
-                # Plot trends
-                fig = px.line(trend_df, x="Month", y=["Expenses", "Sales", "Net"],
-                            title="Monthly Financial Trends",
-                            labels={"value": "Amount (KES)", "variable": "Category"})
-                st.plotly_chart(fig, use_container_width=True)
+        if not trend_df.empty:
+            # Plot trends
+            st.line_chart(trend_df.set_index("Month")[["Expenses", "Sales", "Net"]])
 
-                st.dataframe(trend_df, use_container_width=True)
-                st.markdown(get_download_link(trend_df, "monthly_trends", "📥 Download CSV"), unsafe_allow_html=True)
-            else:
-                st.info("No data available for trend analysis")
+            # Month labels render grid-side — no per-row Python strftime
+            st.dataframe(trend_df, use_container_width=True, hide_index=True, column_config={
+                "Month": st.column_config.DatetimeColumn(format="MMM YYYY")
+            })
+            st.download_button("📥 Download CSV", data=to_csv_bytes(trend_df),
+                               file_name="monthly_trends.csv", mime="text/csv")
         else:
             st.info("No data available for the last 12 months")
 
+@st.fragment
 def show_receipts_tab(conn):
     """Receipt management tab"""
+    today = date.today()
+
     st.header("🧾 Receipt Management")
 
     # Search and filter receipts
     with st.expander("🔍 Search Receipts"):
         cols = st.columns(3)
         with cols[0]:
-            start_date = st.date_input("From Date", value=date.today() - timedelta(days=30))
+            start_date = st.date_input("From Date", value=today - timedelta(days=30))
         with cols[1]:
-            end_date = st.date_input("To Date", value=date.today())
+            end_date = st.date_input("To Date", value=today)
         with cols[2]:
             search_term = st.text_input("Search Receipt ID or Customer")
 
@@ -966,12 +1760,19 @@ def show_receipts_tab(conn):
                 # Reprint receipt button
                 if st.button(f"🖨️ Reprint Receipt", key=f"reprint_{receipt['receipt_id']}"):
                     # Get receipt details
-                    detail_query = "SELECT * FROM receipts WHERE receipt_id = %s"
+                    detail_query = """
+                        SELECT receipt_id, date, customer_name, items_json,
+                               total_amount, payment_mode, reference, issued_by
+                        FROM receipts WHERE receipt_id = %s LIMIT 1
+                    """
                     receipt_detail = execute_query(conn, detail_query, (receipt['receipt_id'],), fetch=True)
                     
                     if receipt_detail:
                         receipt_data = receipt_detail[0]
-                        items = json.loads(receipt_data['items_json'])
+                        # JSONB comes back already parsed; older TEXT rows need json.loads
+                        items = receipt_data['items_json']
+                        if isinstance(items, str):
+                            items = json.loads(items)
                         
                         receipt_info = {
                             "receipt_id": receipt_data['receipt_id'],
@@ -986,12 +1787,13 @@ def show_receipts_tab(conn):
                         
                         receipt_html = generate_receipt_html(receipt_info)
                         st.components.v1.html(receipt_html, height=600)
-                        
-                        # Download link
-                        st.markdown(
-                            f'<a href="data:text/html;base64,{base64.b64encode(receipt_html.encode()).decode()}" '
-                            f'download="receipt_{receipt_data["receipt_id"]}.html" target="_blank">📄 Download Receipt</a>',
-                            unsafe_allow_html=True
+
+                        st.download_button(
+                            "📄 Download Receipt",
+                            data=receipt_html.encode(),
+                            file_name=f"receipt_{receipt_data['receipt_id']}.html",
+                            mime="text/html",
+                            key=f"dl_reprint_{receipt_data['receipt_id']}"
                         )
 
         # Summary statistics
@@ -1005,6 +1807,7 @@ def show_receipts_tab(conn):
     else:
         st.info("No receipts found for the selected criteria")
 
+@st.fragment
 def show_dashboard_tab(conn):
     """Dashboard with key metrics and comprehensive overview"""
     st.header("📊 Dashboard")
@@ -1014,33 +1817,17 @@ def show_dashboard_tab(conn):
     month_start = today.replace(day=1)
     year_start = today.replace(month=1, day=1)
     
-    # Get current month data with proper column aliases
-    expense_query = "SELECT COALESCE(SUM(amount), 0) as total_expenses FROM expenses WHERE date >= %s"
-    sales_query = "SELECT COALESCE(SUM(quantity * selling_price), 0) as total_sales FROM uniform_sales WHERE date >= %s"
-    stock_query = "SELECT COALESCE(SUM(quantity * unit_cost), 0) as stock_value FROM uniform_stock"
-    
-    # Year-to-date queries
-    ytd_expense_query = "SELECT COALESCE(SUM(amount), 0) as ytd_expenses FROM expenses WHERE date >= %s"
-    ytd_sales_query = "SELECT COALESCE(SUM(quantity * selling_price), 0) as ytd_sales FROM uniform_sales WHERE date >= %s"
-    
     try:
-        # Current month data
-        current_expenses = execute_query(conn, expense_query, (month_start,), fetch=True)
-        current_sales = execute_query(conn, sales_query, (month_start,), fetch=True)
-        stock_value = execute_query(conn, stock_query, fetch=True)
-        
-        # Year-to-date data
-        ytd_expenses = execute_query(conn, ytd_expense_query, (year_start,), fetch=True)
-        ytd_sales = execute_query(conn, ytd_sales_query, (year_start,), fetch=True)
+        headline = fetch_dashboard_headline(conn, month_start, year_start)
 
         # Extract values using dictionary keys (since we're using RealDictCursor)
-        expenses_amount = float(current_expenses[0]['total_expenses']) if current_expenses and current_expenses[0] else 0
-        sales_amount = float(current_sales[0]['total_sales']) if current_sales and current_sales[0] else 0
-        inventory_value = float(stock_value[0]['stock_value']) if stock_value and stock_value[0] else 0
+        expenses_amount = float(headline.get('total_expenses') or 0)
+        sales_amount = float(headline.get('total_sales') or 0)
+        inventory_value = float(headline.get('stock_value') or 0)
         net_income = sales_amount - expenses_amount
-        
-        ytd_expenses_amount = float(ytd_expenses[0]['ytd_expenses']) if ytd_expenses and ytd_expenses[0] else 0
-        ytd_sales_amount = float(ytd_sales[0]['ytd_sales']) if ytd_sales and ytd_sales[0] else 0
+
+        ytd_expenses_amount = float(headline.get('ytd_expenses') or 0)
+        ytd_sales_amount = float(headline.get('ytd_sales') or 0)
         ytd_net_income = ytd_sales_amount - ytd_expenses_amount
 
         # Display key metrics
@@ -1080,16 +1867,15 @@ def show_dashboard_tab(conn):
 
         # Recent activity section
         st.subheader("🕒 Recent Activity")
-        
+
+        details = fetch_dashboard_details(conn, month_start)
+
         cols = st.columns(2)
-        
+
         with cols[0]:
             st.markdown("**📤 Recent Expenses**")
-            # Changed ORDER BY to 'date' for robustness if 'created_at' is still an issue on some deployments
-            recent_expenses = execute_query(conn, 
-                "SELECT date, category, description, amount FROM expenses ORDER BY date DESC LIMIT 5", 
-                fetch=True) 
-            
+            recent_expenses = details['recent_expenses']
+
             if recent_expenses:
                 for exp in recent_expenses:
                     with st.container():
@@ -1102,12 +1888,8 @@ def show_dashboard_tab(conn):
 
         with cols[1]:
             st.markdown("**🛍️ Recent Sales**")
-            recent_sales = execute_query(conn,
-                """SELECT date, item, size, quantity, selling_price, 
-                   (quantity * selling_price) as total, student_name 
-                   FROM uniform_sales ORDER BY created_at DESC LIMIT 5""",
-                fetch=True)
-            
+            recent_sales = details['recent_sales']
+
             if recent_sales:
                 for sale in recent_sales:
                     with st.container():
@@ -1121,50 +1903,31 @@ def show_dashboard_tab(conn):
 
         # Category breakdown for current month
         st.subheader("📊 Monthly Expense Breakdown")
-        category_query = """
-            SELECT category, COALESCE(SUM(amount), 0) as total
-            FROM expenses 
-            WHERE date >= %s 
-            GROUP BY category 
-            ORDER BY total DESC
-        """
-        categories = execute_query(conn, category_query, (month_start,), fetch=True)
+        categories = details['categories']
         
         if categories:
+            # Single vectorized cast instead of a per-row float(Decimal) loop
+            category_df = pd.DataFrame(categories)
+            category_df['total'] = category_df['total'].astype(float)
+
             cols = st.columns([2, 1])
             with cols[0]:
-                # Create pie chart data
-                category_names = [cat['category'] for cat in categories]
-                category_amounts = [float(cat['total']) for cat in categories]
-                
-                if any(amount > 0 for amount in category_amounts):
-                    fig = px.pie(
-                        values=category_amounts, 
-                        names=category_names,
-                        title="Expense Distribution by Category"
-                    )
+                if (category_df['total'] > 0).any():
+                    fig = build_category_pie(category_df, 'total', 'category',
+                                             "Expense Distribution by Category")
                     st.plotly_chart(fig, use_container_width=True)
                 else:
                     st.info("No expenses to display in chart")
-            
+
             with cols[1]:
                 st.markdown("**Category Totals:**")
-                for cat in categories:
-                    if cat['total'] > 0:
-                        st.write(f"• **{cat['category']}**: {format_currency(cat['total'])}")
+                for cat in category_df.itertuples():
+                    if cat.total > 0:
+                        st.write(f"• **{cat.category}**: {format_currency(cat.total)}")
 
         # Top selling items
         st.subheader("🏆 Top Selling Items (This Month)")
-        top_items_query = """
-            SELECT item, SUM(quantity) as total_qty, 
-                   SUM(quantity * selling_price) as total_revenue
-            FROM uniform_sales 
-            WHERE date >= %s 
-            GROUP BY item 
-            ORDER BY total_revenue DESC 
-            LIMIT 5
-        """
-        top_items = execute_query(conn, top_items_query, (month_start,), fetch=True)
+        top_items = details['top_items']
         
         if top_items:
             cols = st.columns(len(top_items))
@@ -1180,95 +1943,95 @@ def show_dashboard_tab(conn):
 
         # Low stock alerts
         st.subheader("⚠️ Low Stock Alerts")
-        low_stock_query = """
-            SELECT item, size, quantity, unit_cost
-            FROM uniform_stock 
-            WHERE quantity <= 5 AND quantity > 0
-            ORDER BY quantity ASC
-        """
-        low_stock = execute_query(conn, low_stock_query, fetch=True)
-        
+        # COUNT(*) OVER () in the prepared plan returns the full low-stock
+        # count while only the 4 rows we actually display cross the wire
+        low_stock = details['low_stock']
+
         if low_stock:
-            st.warning(f"🚨 {len(low_stock)} items are running low on stock!")
-            cols = st.columns(min(len(low_stock), 4))
-            for i, item in enumerate(low_stock[:4]):  # Show max 4 items
-                with cols[i % 4]:
+            total_low = low_stock[0]['total_low']
+            st.warning(f"🚨 {total_low} items are running low on stock!")
+            cols = st.columns(len(low_stock))
+            for i, item in enumerate(low_stock):
+                with cols[i]:
                     st.error(f"**{item['item']}** ({item['size']})")
                     st.write(f"Only {item['quantity']} left")
-                    
-            if len(low_stock) > 4:
-                st.write(f"... and {len(low_stock) - 4} more items")
+
+            if total_low > len(low_stock):
+                st.write(f"... and {total_low - len(low_stock)} more items")
         else:
             st.success("✅ All items are adequately stocked")
 
         # Quick stats cards
         st.subheader("📈 Quick Statistics")
         
-        # Get additional statistics
-        stats_queries = {
-            'total_transactions': "SELECT COUNT(*) as count FROM uniform_sales WHERE date >= %s",
-            'avg_sale_value': "SELECT COALESCE(AVG(quantity * selling_price), 0) as avg FROM uniform_sales WHERE date >= %s",
-            'unique_customers': "SELECT COUNT(DISTINCT student_name) as count FROM uniform_sales WHERE date >= %s AND student_name IS NOT NULL",
-            'total_stock_items': "SELECT COALESCE(SUM(quantity), 0) as total FROM uniform_stock" # Added COALESCE here
-        }
-        
-        stats_results = {}
-        for key, query in stats_queries.items():
-            if key == 'total_stock_items':
-                result = execute_query(conn, query, fetch=True)
-            else:
-                result = execute_query(conn, query, (month_start,), fetch=True)
-            stats_results[key] = result[0] if result else {}
+        # The write triggers keep dashboard_summary current, so the normal
+        # case is a single-row primary-key fetch
+        stats_result = execute_query(conn,
+            "SELECT * FROM dashboard_summary WHERE month = date_trunc('month', CURRENT_DATE)",
+            fetch=True)
+
+        if not stats_result:
+            # No write has happened yet this month — compute directly.
+            # One scan of uniform_sales covers the three sales stats; the
+            # stock total rides along as a scalar subquery
+            stats_query = """
+                SELECT COUNT(*) as total_transactions,
+                       COALESCE(AVG(quantity * selling_price), 0) as avg_sale_value,
+                       COUNT(DISTINCT student_name) as unique_customers,
+                       (SELECT COALESCE(SUM(quantity), 0) FROM uniform_stock) as total_stock_items
+                FROM uniform_sales
+                WHERE date >= %s
+            """
+            stats_result = execute_query(conn, stats_query, (month_start,), fetch=True)
+
+        stats = stats_result[0] if stats_result else {}
 
         cols = st.columns(4)
         with cols[0]:
-            transactions = stats_results['total_transactions'].get('count', 0) if stats_results['total_transactions'] else 0
-            st.metric("Monthly Transactions", f"{transactions:,}")
-        
+            st.metric("Monthly Transactions", f"{stats.get('total_transactions', 0):,}")
+
         with cols[1]:
-            avg_sale = stats_results['avg_sale_value'].get('avg', 0) if stats_results['avg_sale_value'] else 0
-            st.metric("Avg Sale Value", format_currency(float(avg_sale)))
-        
+            st.metric("Avg Sale Value", format_currency(float(stats.get('avg_sale_value', 0))))
+
         with cols[2]:
-            customers = stats_results['unique_customers'].get('count', 0) if stats_results['unique_customers'] else 0
-            st.metric("Unique Customers", f"{customers:,}")
-        
+            st.metric("Unique Customers", f"{stats.get('unique_customers', 0):,}")
+
         with cols[3]:
-            stock_items = stats_results['total_stock_items'].get('total', 0) if stats_results['total_stock_items'] else 0
-            st.metric("Total Stock Items", f"{stock_items:,}")
+            st.metric("Total Stock Items", f"{stats.get('total_stock_items', 0):,}")
 
     except Exception as e:
         st.error(f"Error loading dashboard data: {str(e)}")
         st.code(traceback.format_exc())
 
-    # Quick actions
+    # Quick actions — scope="app" because switching tabs has to re-render
+    # the page outside this fragment
     st.subheader("⚡ Quick Actions")
     cols = st.columns(5)
-    
+
     with cols[0]:
         if st.button("➕ Add Expense", use_container_width=True, type="primary"):
             st.session_state.active_tab = "Expenses"
-            st.rerun()
-    
+            st.rerun(scope="app")
+
     with cols[1]:
         if st.button("🛍️ Record Sale", use_container_width=True, type="primary"):
             st.session_state.active_tab = "Sales"
-            st.rerun()
-    
+            st.rerun(scope="app")
+
     with cols[2]:
         if st.button("📦 Manage Stock", use_container_width=True, type="primary"):
             st.session_state.active_tab = "Stock"
-            st.rerun()
-    
+            st.rerun(scope="app")
+
     with cols[3]:
         if st.button("📊 View Reports", use_container_width=True):
             st.session_state.active_tab = "Reports"
-            st.rerun()
-    
+            st.rerun(scope="app")
+
     with cols[4]:
         if st.button("🧾 View Receipts", use_container_width=True):
             st.session_state.active_tab = "Receipts"
-            st.rerun()
+            st.rerun(scope="app")
 
     # Performance tips
     with st.expander("💡 Performance Tips"):
@@ -1298,9 +2061,98 @@ def show_dashboard_tab(conn):
         except Exception as e:
             st.error(f"❌ System check failed: {str(e)}")
 
+@st.fragment
+def show_settings_tab(conn):
+    """Settings and maintenance tab"""
+    st.header("⚙️ Settings")
+
+    st.subheader("📥 Import Expenses from CSV")
+    st.caption("Required columns: date, category, description, amount. Optional: receipt_no")
+    uploaded = st.file_uploader("Expenses CSV", type="csv")
+
+    if uploaded is not None and st.button("Import Expenses", type="primary"):
+        import_df = pd.read_csv(uploaded)
+        required = {"date", "category", "description", "amount"}
+
+        if not required.issubset(import_df.columns):
+            st.error(f"CSV must include columns: {', '.join(sorted(required))}")
+        else:
+            if "receipt_no" not in import_df.columns:
+                import_df["receipt_no"] = None
+            rows = list(import_df[["date", "category", "description", "amount", "receipt_no"]]
+                        .itertuples(index=False, name=None))
+
+            # All rows land in one execute_values round-trip
+            if execute_values_query(conn,
+                    "INSERT INTO expenses (date, category, description, amount, receipt_no) VALUES %s",
+                    rows):
+                st.cache_data.clear()
+                refresh_monthly_financials()
+                st.success(f"Imported {len(rows)} expenses.")
+
+    st.subheader("💾 Backup")
+    st.caption("Exports every table as CSV in one zip archive.")
+    if st.button("Prepare backup"):
+        import zipfile
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            for table in ("expenses", "uniform_stock", "uniform_sales", "receipts"):
+                # Server-side cursor keeps memory at one chunk per table
+                table_df = read_sql_df_chunked(conn, f"SELECT * FROM {table}")
+                archive.writestr(f"{table}.csv", table_df.to_csv(index=False))
+        st.download_button(
+            "📦 Download Backup",
+            data=buffer.getvalue(),
+            file_name=f"backup_{date.today().isoformat()}.zip",
+            mime="application/zip"
+        )
+
+    st.subheader("🧹 Caches")
+    st.caption("Cached queries refresh automatically on writes; use this after external database edits.")
+    if st.button("Clear cached data"):
+        st.cache_data.clear()
+        st.success("Caches cleared.")
+
+    st.subheader("🗑️ Reset All Data")
+    st.warning("This permanently deletes all expenses, stock, sales and receipts!")
+    confirm_reset = st.checkbox("I understand this cannot be undone")
+
+    if st.button("Reset All Data", type="primary", disabled=not confirm_reset):
+        # One TRUNCATE covers every table in a single metadata-level
+        # statement — no per-row DELETE cost and no extra round-trips.
+        # dashboard_summary is derived, so it resets alongside its sources.
+        reset_query = """
+            TRUNCATE expenses, uniform_stock, uniform_sales, receipts, dashboard_summary
+            RESTART IDENTITY
+        """
+        if execute_query(conn, reset_query):
+            st.cache_data.clear()
+            refresh_monthly_financials()
+            st.success("All data has been reset.")
+            st.rerun(scope="app")
+
 # ======================
 # MAIN APPLICATION
 # ======================
+def show_login(conn):
+    """Login gate rendered until the session authenticates"""
+    st.subheader("🔐 Login")
+    if not execute_query(conn, "SELECT 1 FROM users LIMIT 1", fetch=True):
+        st.info("No accounts exist yet. Set ADMIN_PASSWORD in the environment "
+                "(or [admin].password in Streamlit secrets) and restart to "
+                "create the initial admin account.")
+    with st.form("login_form"):
+        username = st.text_input("Username")
+        password = st.text_input("Password", type="password")
+
+        if st.form_submit_button("Login", type="primary"):
+            if check_login(conn, username, password):
+                st.session_state.authenticated = True
+                st.session_state.username = username
+                st.rerun()
+            else:
+                st.error("Invalid username or password")
+
 def main():
     """Main application function"""
     st.title("🏫 Success Achievers School - Expense Tracker")
@@ -1308,23 +2160,38 @@ def main():
 
     # Initialize database connection
     # Pass force_reconnect=False by default, only force reconnect if needed by execute_query
-    conn = get_db_connection(force_reconnect=False) 
+    conn = get_db_connection(force_reconnect=False)
     if not conn:
         st.stop()
 
+    if not st.session_state.get("authenticated"):
+        show_login(conn)
+        st.stop()
+
+    # Report on writes queued during previous reruns
+    reap_pending_writes()
+
+    # Invalidate caches when other sessions write
+    get_change_listener()
+
     # Initialize session state
     if "active_tab" not in st.session_state:
         st.session_state.active_tab = "Dashboard"
 
-    # Sidebar navigation
+    # Sidebar navigation — a radio tracks its own state, so switching tabs
+    # costs one rerun instead of the button-click + manual st.rerun() pair
     st.sidebar.title("Navigation")
-    tabs = ["Dashboard", "Expenses", "Stock", "Sales", "Reports", "Receipts"]
-    
-    for tab in tabs:
-        if st.sidebar.button(tab, use_container_width=True, 
-                           type="primary" if st.session_state.active_tab == tab else "secondary"):
-            st.session_state.active_tab = tab
-            st.rerun()
+    tabs = ["Dashboard", "Expenses", "Stock", "Sales", "Reports", "Receipts", "Settings"]
+
+    if st.session_state.active_tab not in tabs:
+        st.session_state.active_tab = "Dashboard"
+
+    selected_tab = st.sidebar.radio(
+        "Navigation", tabs,
+        index=tabs.index(st.session_state.active_tab),
+        label_visibility="collapsed"
+    )
+    st.session_state.active_tab = selected_tab
 
     # Display selected tab
     try:
@@ -1340,6 +2207,8 @@ def main():
             show_reports_tab(conn)
         elif st.session_state.active_tab == "Receipts":
             show_receipts_tab(conn)
+        elif st.session_state.active_tab == "Settings":
+            show_settings_tab(conn)
 
     except Exception as e:
         st.error(f"An error occurred: {str(e)}")